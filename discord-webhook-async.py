@@ -1,128 +1,422 @@
 import aiohttp
 import asyncio
+import importlib.util
+import json
 import logging
-import time
-from typing import Optional, Dict, Any, List
+import os
+import random
+from typing import Optional, Dict, Any, List, NamedTuple, AsyncIterator, Union, Tuple
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
+import yarl
+
+try:
+    import orjson
+
+    def _json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    _json_dumps = json.dumps
+
+try:
+    import aiofiles
+except ImportError:
+    aiofiles = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+# Errors raised by the HTTP clients when a request could not be completed
+_TRANSPORT_ERRORS = (aiohttp.ClientError,) if httpx is None else (aiohttp.ClientError, httpx.HTTPError)
+
+# Upper bound for a single retry delay, in seconds
+MAX_BACKOFF = 60.0
+
+# Size of the chunks read from disk when uploading a file, in bytes
+FILE_CHUNK_SIZE = 64 * 1024
+
+# Discord accepts at most this many embeds in a single message
+MAX_EMBEDS_PER_MESSAGE = 10
+
+# Concurrency limits shared by every DiscordWebhook pointing at the same webhook, per event loop.
+# A semaphore is bound to the loop that first waits on it, so each loop needs its own.
+_semaphores: Dict[Tuple[asyncio.AbstractEventLoop, str], asyncio.Semaphore] = {}
+
+# Sessions shared by every DiscordWebhook created with shared_session=True, keyed by event loop and http2 flag.
+# A session can only be used on the loop it was created on.
+_shared_sessions: Dict[Tuple[asyncio.AbstractEventLoop, bool], Any] = {}
+
+
+def _drop_closed_loops(cache: Dict[Tuple[asyncio.AbstractEventLoop, Any], Any]):
+    """Forgets cached objects that belong to event loops which have been closed."""
+    for key in [key for key in cache if key[0].is_closed()]:
+        del cache[key]
+
+
+def _message_payload(content: Optional[str], username: Optional[str], avatar_url: Optional[str],
+                     embeds: Optional[List[Dict[str, Any]]]) -> Dict[str, Any]:
+    """Builds the payload for sending or editing a message, leaving out unset fields."""
+    # Only set fields are inserted, so no intermediate dict full of None values is built and filtered
+    payload = {}
+    if content is not None:
+        payload["content"] = content
+    if username is not None:
+        payload["username"] = username
+    if avatar_url is not None:
+        payload["avatar_url"] = avatar_url
+    if embeds:
+        payload["embeds"] = embeds
+    return payload
+
+
+async def _read_file(path: str) -> AsyncIterator[bytes]:
+    """Reads a file in chunks without blocking the event loop."""
+    if aiofiles is not None:
+        async with aiofiles.open(path, 'rb') as f:
+            while chunk := await f.read(FILE_CHUNK_SIZE):
+                yield chunk
+        return
+
+    loop = asyncio.get_running_loop()
+    f = await loop.run_in_executor(None, open, path, 'rb')
+    try:
+        while chunk := await loop.run_in_executor(None, f.read, FILE_CHUNK_SIZE):
+            yield chunk
+    finally:
+        await loop.run_in_executor(None, f.close)
+
+
+class _Response(NamedTuple):
+    """Client-independent view of a completed HTTP response."""
+    status: int
+    reason: str
+    headers: Any
+    body: bytes
+
+
+def _create_session(http2: bool) -> Any:
+    """Creates an httpx client for HTTP/2, or an aiohttp session on a tuned connector otherwise."""
+    if http2:
+        return httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+            timeout=30
+        )
+    connector = aiohttp.TCPConnector(
+        limit=100,
+        limit_per_host=64,
+        ttl_dns_cache=300,
+        keepalive_timeout=75,
+        enable_cleanup_closed=True
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        # Webhooks don't use cookies, so don't store or resend them between requests
+        cookie_jar=aiohttp.DummyCookieJar(),
+        json_serialize=_json_dumps,
+        timeout=aiohttp.ClientTimeout(total=30)
+    )
+
+
+def _is_closed(session: Any) -> bool:
+    """Checks whether an aiohttp session or httpx client has been closed."""
+    if isinstance(session, aiohttp.ClientSession):
+        return session.closed
+    return session.is_closed
+
+
+async def _close_session(session: Any):
+    """Closes an aiohttp session or httpx client."""
+    if isinstance(session, aiohttp.ClientSession):
+        await session.close()
+    else:
+        await session.aclose()
+
+
+async def shutdown_shared_session():
+    """Closes the sessions shared between webhooks on the running event loop. Call it once before the loop ends."""
+    loop = asyncio.get_running_loop()
+    _drop_closed_loops(_shared_sessions)
+    for key in [key for key in _shared_sessions if key[0] is loop]:
+        await _close_session(_shared_sessions.pop(key))
 
 
 class DiscordWebhook:
-    def __init__(self, url: str, retries: int = 3, backoff_factor: float = 1.0):
+    def __init__(self, url: str, retries: int = 3, backoff_factor: float = 1.0, max_concurrency: int = 5,
+                 http2: bool = False, shared_session: bool = False):
         """
         Initialize the webhook.
 
         :param url: Webhook URL.
         :param retries: Number of retries if a request fails.
         :param backoff_factor: Multiplier for exponential backoff time between retries.
+        :param max_concurrency: Maximum number of in-flight requests to this webhook. The limit is shared
+            by all instances using the same webhook, the first one to send a request sets it.
+        :param http2: Send requests over HTTP/2 using httpx instead of aiohttp (requires httpx[http2]).
+        :param shared_session: Use one module-level session, and its connection pool, for every webhook that
+            sets this flag instead of a session of its own. Close it with shutdown_shared_session().
         """
+        # httpx needs its http2 extra (the h2 package) for HTTP/2, check both so the hint is shown up front
+        if http2 and (httpx is None or importlib.util.find_spec("h2") is None):
+            raise ImportError("http2=True requires httpx, install it with: pip install httpx[http2]")
         self.url = url
+        # Parsed once so aiohttp doesn't have to re-parse the URL on every request
+        self._url = yarl.URL(url)
+        self._messages_url = self._url / "messages"
+        self._wait_url = self._url.update_query(wait="true")
         self.session = None
+        self.http2 = http2
+        self.shared_session = shared_session
         self.retries = retries
         self.backoff_factor = backoff_factor
+        self._rate_limit_reset = 0.0
+        self.max_concurrency = max_concurrency
+        # Without the trailing slash, so both spellings of a webhook URL share one concurrency limit
+        self._semaphore_key = self._url.path.rstrip('/')
 
     async def _get_session(self):
         """Creates a session if one doesn't exist and returns it."""
-        if not self.session:
-            self.session = aiohttp.ClientSession()
+        if self.shared_session:
+            # Creating a session never awaits, so no lock is needed to create it only once
+            key = (asyncio.get_running_loop(), self.http2)
+            session = _shared_sessions.get(key)
+            if session is None or _is_closed(session):
+                _drop_closed_loops(_shared_sessions)
+                session = _shared_sessions[key] = _create_session(self.http2)
+            return session
+        if self.session is None or _is_closed(self.session):
+            self.session = _create_session(self.http2)
         return self.session
 
     async def close(self):
-        """Closes the session."""
-        if self.session:
-            await self.session.close()
+        """Closes the session. The shared session stays open, see shutdown_shared_session()."""
+        if self.session is not None:
+            await _close_session(self.session)
+
+    async def __aenter__(self):
+        await self._get_session()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
 
     async def send_message(self, content: Optional[str] = None, username: Optional[str] = None,
                            avatar_url: Optional[str] = None, embed: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """Sends a message via the Discord webhook."""
-        payload = {
-            "content": content,
-            "username": username,
-            "avatar_url": avatar_url,
-            "embeds": [embed] if embed else None
-        }
+        payload = _message_payload(content, username, avatar_url, [embed] if embed else None)
         return await self._send_request(payload)
 
+    async def post_and_track(self, content: Optional[str] = None, username: Optional[str] = None,
+                             avatar_url: Optional[str] = None,
+                             embed: Optional[Dict[str, Any]] = None) -> Union["WebhookMessage", Dict[str, Any]]:
+        """Sends a message and returns a WebhookMessage to edit or delete it, or the error dict on failure."""
+        payload = _message_payload(content, username, avatar_url, [embed] if embed else None)
+        # With wait=true Discord answers with the created message, so its ID comes back in the same request
+        response = await self._send_request(payload, url=self._wait_url)
+        if "id" not in response:
+            return response
+        return WebhookMessage(self, response)
+
     async def send_embed(self, title: str, description: str, color: int = 0x000000,
                          fields: Optional[List[Dict[str, Any]]] = None, footer: Optional[str] = None,
                          image_url: Optional[str] = None, thumbnail_url: Optional[str] = None) -> Dict[str, Any]:
         """Sends an embed message with additional formatting options."""
-        embed = {
-            "title": title,
-            "description": description,
-            "color": color,
-            "fields": fields if fields else [],
-            "footer": {"text": footer} if footer else None,
-            "image": {"url": image_url} if image_url else None,
-            "thumbnail": {"url": thumbnail_url} if thumbnail_url else None
-        }
+        embed = {"title": title, "description": description, "color": color}
+        if fields:
+            embed["fields"] = fields
+        if footer:
+            embed["footer"] = {"text": footer}
+        if image_url:
+            embed["image"] = {"url": image_url}
+        if thumbnail_url:
+            embed["thumbnail"] = {"url": thumbnail_url}
         return await self.send_message(embed=embed)
 
+    async def send_embeds(self, embeds: List[Dict[str, Any]], content: Optional[str] = None,
+                          username: Optional[str] = None, avatar_url: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Sends several embeds, packing up to 10 of them into each message. The content goes with the first one."""
+        responses = []
+        for i in range(0, len(embeds), MAX_EMBEDS_PER_MESSAGE):
+            payload = _message_payload(content if i == 0 else None, username, avatar_url,
+                                       embeds[i:i + MAX_EMBEDS_PER_MESSAGE])
+            responses.append(await self._send_request(payload))
+        return responses
+
     async def send_file(self, file_path: str, content: Optional[str] = None, username: Optional[str] = None,
                         avatar_url: Optional[str] = None) -> Dict[str, Any]:
         """Sends a file via the webhook."""
-        async with aiohttp.ClientSession() as session:
-            with open(file_path, 'rb') as f:
-                files = {'file': f}
-                data = {
-                    'content': content,
-                    'username': username,
-                    'avatar_url': avatar_url
-                }
-                return await self._send_request(data, files=files, session=session)
+        if not os.path.isfile(file_path):
+            raise FileNotFoundError(f"No such file: '{file_path}'")
+        data = _message_payload(content, username, avatar_url, None)
+        return await self._send_request(data, files={'file': file_path})
 
     async def edit_message(self, message_id: str, content: Optional[str] = None,
                            username: Optional[str] = None, avatar_url: Optional[str] = None,
                            embed: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
         """Edits a previously sent message by its ID."""
-        payload = {
-            "content": content,
-            "username": username,
-            "avatar_url": avatar_url,
-            "embeds": [embed] if embed else None
-        }
-        edit_url = f"{self.url}/messages/{message_id}"
-        return await self._send_request(payload, method='PATCH', url=edit_url)
+        payload = _message_payload(content, username, avatar_url, [embed] if embed else None)
+        return await self._send_request(payload, method='PATCH', url=self._messages_url / str(message_id))
 
     async def delete_message(self, message_id: str) -> Dict[str, Any]:
         """Deletes a message by its ID."""
-        delete_url = f"{self.url}/messages/{message_id}"
-        return await self._send_request({}, method='DELETE', url=delete_url)
+        return await self._send_request({}, method='DELETE', url=self._messages_url / str(message_id))
 
     async def get_webhook_info(self) -> Dict[str, Any]:
         """Retrieves information about the webhook (e.g., name, avatar)."""
         return await self._send_request({}, method='GET')
 
-    async def _send_request(self, data: Dict[str, Any], method: str = 'POST', files: Optional[dict] = None,
-                            session: Optional[aiohttp.ClientSession] = None, url: Optional[str] = None) -> Dict[
+    async def _send_request(self, data: Dict[str, Any], method: str = 'POST', files: Optional[Dict[str, str]] = None,
+                            session: Optional[Any] = None, url: Optional[yarl.URL] = None) -> Dict[
         str, Any]:
         """Sends a request to the webhook with retries in case of errors."""
-        url = url or self.url
+        url = url or self._url
         session = session or await self._get_session()
-        attempt = 0
-        while attempt <= self.retries:
-            try:
-                async with session.request(method, url, json=data) as response:
-                    response.raise_for_status()
-                    return await response.json()
-            except aiohttp.ClientResponseError as e:
-                logging.error(f"HTTP Error: {e.status} - {e.message}")
-                if attempt == self.retries:
-                    return {"error": f"Max retries reached: {e.message}"}
-            except aiohttp.ClientError as e:
-                logging.error(f"Request failed: {e}")
-                if attempt == self.retries:
-                    return {"error": f"Request failed: {e}"}
-            except Exception as e:
-                logging.error(f"Unexpected error: {e}")
-                if attempt == self.retries:
-                    return {"error": f"Unexpected error: {e}"}
-
-            attempt += 1
-            backoff_time = self.backoff_factor * (2 ** attempt)
-            logging.info(f"Retrying in {backoff_time} seconds...")
-            await asyncio.sleep(backoff_time)
+        async with self._get_semaphore():
+            attempt = 0
+            while attempt <= self.retries:
+                retry_after = None
+                await self._wait_for_rate_limit()
+                try:
+                    response = await self._request_once(session, method, url, data, files)
+                    if response.status == 429:
+                        retry_after = self._get_retry_after(response)
+                        logger.warning(f"Rate limited, retry after {retry_after:.2f} seconds")
+                        if attempt == self.retries:
+                            return {"error": "Max retries reached: rate limited"}
+                    elif response.status >= 400:
+                        logger.error(f"HTTP Error: {response.status} - {response.reason}")
+                        # Client errors other than a timeout will fail the same way if retried
+                        if response.status < 500 and response.status != 408:
+                            return {"error": f"{response.status}: {response.reason}"}
+                        if attempt == self.retries:
+                            return {"error": f"Max retries reached: {response.reason}"}
+                    else:
+                        self._update_rate_limit(response)
+                        return json.loads(response.body) if response.body else {}
+                except _TRANSPORT_ERRORS as e:
+                    logger.error(f"Request failed: {e}")
+                    if attempt == self.retries:
+                        return {"error": f"Request failed: {e}"}
+                except Exception as e:
+                    logger.error(f"Unexpected error: {e}")
+                    if attempt == self.retries:
+                        return {"error": f"Unexpected error: {e}"}
+
+                attempt += 1
+                if retry_after is not None:
+                    backoff_time = retry_after
+                else:
+                    base = self.backoff_factor * (2 ** attempt)
+                    backoff_time = min(random.uniform(base * 0.5, base * 1.5), MAX_BACKOFF)
+                logger.info(f"Retrying in {backoff_time:.2f} seconds...")
+                await asyncio.sleep(backoff_time)
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        """Returns the concurrency limit for this webhook on the running event loop."""
+        key = (asyncio.get_running_loop(), self._semaphore_key)
+        semaphore = _semaphores.get(key)
+        if semaphore is None:
+            _drop_closed_loops(_semaphores)
+            semaphore = _semaphores[key] = asyncio.Semaphore(self.max_concurrency)
+        return semaphore
+
+    async def _request_once(self, session: Any, method: str, url: yarl.URL, data: Dict[str, Any],
+                            files: Optional[Dict[str, str]]) -> _Response:
+        """Performs a single request with either aiohttp or httpx and reads the whole response."""
+        if isinstance(session, aiohttp.ClientSession):
+            if files:
+                # Large uploads can take longer than the session's total timeout, only limit stalls instead
+                kwargs = {
+                    "data": self._build_form(data, files),
+                    "timeout": aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30)
+                }
+            else:
+                kwargs = {"json": data}
+            async with session.request(method, url, **kwargs) as response:
+                return _Response(response.status, response.reason or "", response.headers, await response.read())
+
+        if files:
+            kwargs = {"data": {"payload_json": _json_dumps(data)}, "files": await self._build_httpx_files(files)}
+        else:
+            kwargs = {"content": _json_dumps(data), "headers": {"Content-Type": "application/json"}}
+        response = await session.request(method, str(url), **kwargs)
+        return _Response(response.status_code, response.reason_phrase, response.headers, response.content)
+
+    async def _build_httpx_files(self, files: Dict[str, str]) -> Dict[str, Any]:
+        """Reads the attached files for an httpx multipart upload."""
+        # httpx can't stream multipart parts from an async source, so the files are read into memory
+        prepared = {}
+        for name, path in files.items():
+            prepared[name] = (os.path.basename(path), b"".join([chunk async for chunk in _read_file(path)]))
+        return prepared
+
+    def _build_form(self, data: Dict[str, Any], files: Dict[str, str]) -> aiohttp.FormData:
+        """Builds a multipart form with the JSON payload and the attached files."""
+        form = aiohttp.FormData()
+        form.add_field("payload_json", _json_dumps(data), content_type="application/json")
+        for name, path in files.items():
+            # The form is rebuilt on every retry, so each attempt streams the file from the start
+            form.add_field(name, _read_file(path), filename=os.path.basename(path),
+                           content_type="application/octet-stream")
+        return form
+
+    def _get_retry_after(self, response: _Response) -> float:
+        """Returns how long Discord asked us to wait before retrying a rate-limited request."""
+        for header in ("Retry-After", "X-RateLimit-Reset-After"):
+            value = response.headers.get(header)
+            if value:
+                try:
+                    return float(value)
+                except ValueError:
+                    pass
+        try:
+            return float(json.loads(response.body)["retry_after"])
+        except (ValueError, KeyError, TypeError):
+            return self.backoff_factor
+
+    def _update_rate_limit(self, response: _Response):
+        """Remembers when the rate limit bucket resets if the last request exhausted it."""
+        if response.headers.get("X-RateLimit-Remaining") != "0":
+            return
+        try:
+            reset_after = float(response.headers.get("X-RateLimit-Reset-After", ""))
+        except ValueError:
+            return
+        self._rate_limit_reset = asyncio.get_running_loop().time() + reset_after
+
+    async def _wait_for_rate_limit(self):
+        """Sleeps until the rate limit bucket resets if it was exhausted by a previous request."""
+        delay = self._rate_limit_reset - asyncio.get_running_loop().time()
+        if delay > 0:
+            logger.info(f"Rate limit exhausted, waiting {delay:.2f} seconds...")
+            await asyncio.sleep(delay)
+
+
+class WebhookMessage:
+    def __init__(self, webhook: DiscordWebhook, data: Dict[str, Any]):
+        """
+        A message sent by post_and_track.
+
+        :param webhook: Webhook that sent the message.
+        :param data: Message object returned by Discord.
+        """
+        self.webhook = webhook
+        self.data = data
+        self.id = data["id"]
+        self._url = webhook._messages_url / str(self.id)
+
+    async def edit(self, content: Optional[str] = None, username: Optional[str] = None,
+                   avatar_url: Optional[str] = None, embed: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Edits the message."""
+        payload = _message_payload(content, username, avatar_url, [embed] if embed else None)
+        response = await self.webhook._send_request(payload, method='PATCH', url=self._url)
+        if "id" in response:
+            self.data = response
+        return response
+
+    async def delete(self) -> Dict[str, Any]:
+        """Deletes the message."""
+        return await self.webhook._send_request({}, method='DELETE', url=self._url)